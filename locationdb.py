@@ -3,10 +3,11 @@
 import os
 import re
 import json
+import bisect
 import pickle
 import string
 import unicodedata
-from typing import List, Tuple, Dict, Any, Set
+from typing import List, Tuple, Dict, Any, Set, Iterator
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_JSON = os.path.join(ROOT_DIR, "locations.json")
@@ -26,12 +27,17 @@ NON_UNICODE_CHARS = {'ł': 'l', 'ß': 'ss', '‘': '\'', 'æ': 'ae',
                      'ə': 'e', 'ʿ': '\'', 'þ': 'p', 'м': 'm'}
 
 
+NON_UNICODE_CHARS_TABLE = str.maketrans(NON_UNICODE_CHARS)
+
+# Up to this many queued cities are inserted one by one, more are merged
+INSORT_LIMIT = 256
+
+
 def _normalize_text(text: str, keep_diacritics=False) -> str:
     text = "".join(text.lower().split())
     if not keep_diacritics:
         text = unicodedata.normalize('NFD', text)
-        for char in NON_UNICODE_CHARS:
-            text = text.replace(char, NON_UNICODE_CHARS[char])
+        text = text.translate(NON_UNICODE_CHARS_TABLE)
         text = text.encode('ascii', 'ignore').decode("utf-8")
     return text
 
@@ -73,64 +79,134 @@ class EX_CityDataBaseNotOpened(Exception):
     pass
 
 
+def load_json_database() -> Tuple[bool, Dict[str, Any]]:
+    db_json: Dict[str, Any] = {}
+    try:
+        with open(DB_JSON, 'r', encoding="utf8") as f:
+            db_json = json.load(f)
+            return True, db_json
+    except IOError as e:
+        print('Failed to open database file. Error:', e)
+    except json.JSONDecodeError as e:
+        print('Database file is corrupted. Error:', e)
+    return False, db_json
+
+
+def regenerate_cities(json_db: Dict[str, Any]) -> Iterator[City]:
+    keys = json_db[KEYS]
+    for country_name in json_db[DATA]:
+        data = json_db[DATA][country_name]
+        tmp_dict: Dict[str, Any] = {}
+        for i, data_bit in enumerate(data):
+            i = i % len(keys)
+            if len(tmp_dict) == len(keys):
+                yield City(tmp_dict[NAME], country_name,
+                           tmp_dict[LAT], tmp_dict[LON])
+                tmp_dict.clear()
+            tmp_dict[keys[i]] = data_bit
+
+
 class CityTree:
+    """Prefix index of cities by normalized name.
+
+    Normalized names are kept in one sorted list, parallel to the list of
+    cities, so every prefix maps to a contiguous slice found by bisection.
+    Cities with equal names stay in the order they were added.
+    """
+
     def __init__(self):
-        self.__root: Dict[str, Dict] = {}
+        self.__keys: List[str] = []
+        self.__cities: List[City] = []
+        self.__pending_keys: List[str] = []
+        self.__pending_cities: List[City] = []
+
+    @classmethod
+    def from_cities(cls, cities: List[City]) -> "CityTree":
+        """Bulk build of the tree: every distinct name is normalized once
+        and all cities are sorted in one pass."""
+        names = list(dict.fromkeys(city.name for city in cities))
+        normalized = dict(zip(names, map(_normalize_text, names)))
+        keys = [normalized[city.name] for city in cities]
+
+        # stable, so cities with equal names keep their order
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[i] for i in order]
+        # cities without a searchable name sort first and are dropped
+        first = bisect.bisect_right(sorted_keys, "")
+
+        tree = cls()
+        tree.__keys = sorted_keys[first:]
+        tree.__cities = [cities[i] for i in order[first:]]
+        return tree
+
+    def __flush(self):
+        if not self.__pending_keys:
+            return
+        keys, cities = self.__pending_keys, self.__pending_cities
+        self.__pending_keys = []
+        self.__pending_cities = []
+
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        if len(order) <= INSORT_LIMIT:
+            # queued keys are sorted, so each one lands after the previous
+            lo = 0
+            for i in order:
+                lo = bisect.bisect_right(self.__keys, keys[i], lo)
+                self.__keys.insert(lo, keys[i])
+                self.__cities.insert(lo, cities[i])
+                lo += 1
+        else:
+            # the index and the sorted queue are two runs, which timsort
+            # merges in one linear pass (about twice as fast as heapq.merge)
+            keys = self.__keys + [keys[i] for i in order]
+            cities = self.__cities + [cities[i] for i in order]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.__keys = [keys[i] for i in order]
+            self.__cities = [cities[i] for i in order]
 
     def __iter__(self):
-        for city in self.__get_cities_recursive(self.__root):
+        self.__flush()
+        for city in self.__cities:
             yield city
 
     def add(self, city: City) -> bool:
+        """Queue the city; queued cities are merged into the index on the
+        next lookup, so a run of `add` calls is sorted only once."""
         city_name = city.searchable_name_normalized()
         if city_name:
-            curr_node = self.__root
-            for char in city_name:
-                if not char in curr_node:
-                    curr_node[char] = {}
-                curr_node = curr_node[char]
-            if "" in curr_node:
-                curr_node[""].append(city)
-            else:
-                curr_node[""] = [city]
+            self.__pending_keys.append(city_name)
+            self.__pending_cities.append(city)
             return True
         return False
 
     def find(self, city_name: str) -> List[City]:
+        self.__flush()
         city_name = _normalize_text(city_name)
         if city_name:
-            curr_node = self.__root
-            for char in city_name:
-                if char in curr_node:
-                    curr_node = curr_node[char]
-                else:
-                    return []
-            return curr_node.get("", [])
+            begin = bisect.bisect_left(self.__keys, city_name)
+            end = bisect.bisect_right(self.__keys, city_name, begin)
+            return self.__cities[begin:end]
         return []
 
-    def __get_cities_recursive(self, node: Dict[str, Dict]) -> List[City]:
-        cities: List[City] = []
-        if "" in node:
-            cities.extend(node[""])
-        for key in node.keys():
-            if key != "":
-                cities.extend(self.__get_cities_recursive(node[key]))
-        return cities
-
     def find_any(self, city_name: str) -> List[City]:
+        positions = self.find_any_positions(city_name)
+        return self.__cities[positions.start:positions.stop]
+
+    def find_any_positions(self, city_name: str) -> range:
+        """Positions, in iteration order, of the cities `find_any` returns."""
+        self.__flush()
         city_name = _normalize_text(city_name)
         if city_name:
-            curr_node = self.__root
-            for char in city_name:
-                if char in curr_node:
-                    curr_node = curr_node[char]
-                else:
-                    return []
-            return self.__get_cities_recursive(curr_node)
-        return []
+            # first string greater than every string starting with city_name
+            prefix_end = city_name[:-1] + chr(ord(city_name[-1]) + 1)
+            begin = bisect.bisect_left(self.__keys, city_name)
+            end = bisect.bisect_left(self.__keys, prefix_end, begin)
+            return range(begin, end)
+        return range(0)
 
     def size(self) -> int:
-        return len(self.__get_cities_recursive(self.__root))
+        self.__flush()
+        return len(self.__cities)
 
 
 class CityDataBase:
@@ -143,18 +219,8 @@ class CityDataBase:
             yield city
 
     def open_from_json(self) -> bool:
-        success = False
         self.__is_opened = False
-        db_json = {}
-        try:
-            with open(DB_JSON, 'r', encoding="utf8") as f:
-                db_json = json.load(f)
-                success = True
-        except IOError as e:
-            print('Failed to open database file. Error:', e)
-        except json.JSONDecodeError as e:
-            print('Database file is corrupted. Error:', e)
-
+        success, db_json = load_json_database()
         if success and self.__regenerate_database(db_json):
             self.__is_opened = True
             return True
@@ -165,18 +231,7 @@ class CityDataBase:
 
     def __regenerate_database(self, json_db: Dict[str, Any]) -> bool:
         try:
-            keys = json_db[KEYS]
-            for country_name in json_db[DATA]:
-                data = json_db[DATA][country_name]
-                tmp_dict: Dict[str, Any] = {}
-                for i, data_bit in enumerate(data):
-                    i = i % len(keys)
-                    if len(tmp_dict) == len(keys):
-                        city = City(tmp_dict[NAME], country_name,
-                                    tmp_dict[LAT], tmp_dict[LON])
-                        self.__city_tree.add(city)
-                        tmp_dict.clear()
-                    tmp_dict[keys[i]] = data_bit
+            self.__city_tree = CityTree.from_cities(list(regenerate_cities(json_db)))
             return True
         except KeyError as e:
             print(e)
@@ -0,0 +1,262 @@
+#!/bin/python3
+
+import heapq
+import zlib
+import itertools
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import List, Tuple, Dict, Any, Optional
+
+from locationdb import (City, CityTree, EX_CityDataBaseNotOpened,
+                        load_json_database, regenerate_cities)
+
+
+# Partitioning strategies
+PARTITION_BY_COUNTRY = "country"
+PARTITION_BY_HASH = "hash"
+
+# Shard worker commands
+CMD_SEARCH = "search"
+CMD_COUNT = "count"
+CMD_CLOSE = "close"
+
+# Seconds to wait for a shard worker to exit before terminating it
+SHARD_JOIN_TIMEOUT = 5
+
+
+def _partition_by_country(cities: List[City], shards_count: int) -> List[List[int]]:
+    countries: Dict[str, List[int]] = {}
+    for rank, city in enumerate(cities):
+        countries.setdefault(city.country, []).append(rank)
+
+    # Rebalance at load time: place the biggest countries first,
+    # always on the shard which currently holds the fewest cities.
+    shards: List[List[int]] = [[] for _ in range(shards_count)]
+    load = [(0, i) for i in range(shards_count)]
+    for country_ranks in sorted(countries.values(), key=len, reverse=True):
+        size, i = heapq.heappop(load)
+        shards[i].extend(country_ranks)
+        heapq.heappush(load, (size + len(country_ranks), i))
+    for shard_ranks in shards:
+        shard_ranks.sort()
+    return shards
+
+
+def _partition_by_hash(cities: List[City], shards_count: int) -> List[List[int]]:
+    shards: List[List[int]] = [[] for _ in range(shards_count)]
+    for rank, city in enumerate(cities):
+        key = city.searchable_name_normalized().encode("utf-8")
+        shards[zlib.crc32(key) % shards_count].append(rank)
+    return shards
+
+
+PARTITIONERS = {PARTITION_BY_COUNTRY: _partition_by_country,
+                PARTITION_BY_HASH: _partition_by_hash}
+
+
+# Search result as sent by a shard: global rank, name, country, latitude, longitude
+Row = Tuple[int, str, str, Any, Any]
+
+
+def _shard_worker(conn: Connection, ranks: List[int], cities: List[City]):
+    # Cities arrive sorted by rank, which is the order CityTree keeps them in,
+    # so a tree position maps straight to the row of its city.
+    city_tree = CityTree.from_cities(cities)
+    rows: List[Row] = [(rank, city.name, city.country, city.latitude, city.longitude)
+                       for rank, city in zip(ranks, cities)]
+    del cities
+    conn.send(city_tree.size())
+
+    def search(text: str, stop: Optional[int]) -> Tuple[int, List[Row]]:
+        positions = city_tree.find_any_positions(text)
+        end = positions.stop
+        if stop is not None:
+            end = min(end, positions.start + stop)
+        return len(positions), rows[positions.start:end]
+
+    while True:
+        command, payload = conn.recv()
+        if command == CMD_SEARCH:
+            texts, stop = payload
+            conn.send([search(text, stop) for text in texts])
+        elif command == CMD_COUNT:
+            conn.send([len(city_tree.find_any_positions(text)) for text in payload])
+        elif command == CMD_CLOSE:
+            break
+    conn.close()
+
+
+class ShardedCityDataBase:
+    """Scatter-gather front of CityDataBase.
+
+    Cities are partitioned across `shards_count` worker processes, which are
+    the only holders of the data. Every city gets a global rank at load time
+    (its position in a CityTree of all cities), so results come in the same
+    order as from CityDataBase.search. For each query a shard answers with its
+    match count and at most `offset + limit` rows, and the coordinator only
+    merges those rows by rank, which keeps its per-query work bounded by the
+    page size rather than by the number of matches.
+    """
+
+    def __init__(self, shards_count: Optional[int] = None,
+                 partition: str = PARTITION_BY_COUNTRY):
+        if shards_count is None:
+            shards_count = multiprocessing.cpu_count()
+        if shards_count < 1:
+            raise ValueError("shards_count must be at least 1")
+        if partition not in PARTITIONERS:
+            raise ValueError(f"Unknown partition strategy: '{partition}'")
+        self.__shards_count = shards_count
+        self.__partition = partition
+        self.__connections: List[Connection] = []
+        self.__processes: List[multiprocessing.Process] = []
+        self.__shard_sizes: List[int] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def open_from_json(self) -> bool:
+        self.close()
+        success, db_json = load_json_database()
+        if not success:
+            return False
+        try:
+            cities = list(CityTree.from_cities(list(regenerate_cities(db_json))))
+        except KeyError as e:
+            print(e)
+            return False
+
+        shards = PARTITIONERS[self.__partition](cities, self.__shards_count)
+        for shard_ranks in shards:
+            shard_cities = [cities[rank] for rank in shard_ranks]
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker,
+                                              args=(child_conn, shard_ranks, shard_cities),
+                                              daemon=True)
+            process.start()
+            child_conn.close()
+            self.__connections.append(parent_conn)
+            self.__processes.append(process)
+        try:
+            self.__shard_sizes = [conn.recv() for conn in self.__connections]
+        except (EOFError, OSError) as e:
+            print('Shard worker exited before building its index. Error:', repr(e))
+            self.close()
+            return False
+        return True
+
+    def opened(self) -> bool:
+        return bool(self.__connections)
+
+    def shard_sizes(self) -> List[int]:
+        return list(self.__shard_sizes)
+
+    def close(self):
+        for conn in self.__connections:
+            try:
+                conn.send((CMD_CLOSE, None))
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process in self.__processes:
+            process.join(SHARD_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.__connections.clear()
+        self.__processes.clear()
+        self.__shard_sizes.clear()
+
+    def __scatter_gather(self, command: str, payload: Any) -> List[Any]:
+        if not self.opened():
+            raise EX_CityDataBaseNotOpened(
+                "Open database using class built-in method: 'open_from_json' before trying to search for anything")
+        try:
+            for conn in self.__connections:
+                conn.send((command, payload))
+            return [conn.recv() for conn in self.__connections]
+        except Exception:
+            # replies of the other shards would answer the next query
+            self.close()
+            raise
+
+    def search(self, text: str, limit: Optional[int] = None, offset: int = 0) -> List[City]:
+        return self.search_many([text], limit, offset)[0]
+
+    def search_many(self, texts: List[str], limit: Optional[int] = None,
+                    offset: int = 0) -> List[List[City]]:
+        stop = None if limit is None else offset + limit
+        shard_results = self.__scatter_gather(CMD_SEARCH, (texts, stop))
+        results: List[List[City]] = []
+        for replies in zip(*shard_results):
+            # ranks are unique, so rows never compare past their first item
+            rows = sorted(itertools.chain.from_iterable(rows for _, rows in replies))
+            results.append([City(*row[1:]) for row in rows[offset:stop]])
+        return results
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        shard_results = self.__scatter_gather(CMD_COUNT, texts)
+        return [sum(counts) for counts in zip(*shard_results)]
+
+
+def benchmark(shard_counts: Optional[List[int]] = None, partition: str = PARTITION_BY_COUNTRY,
+              rounds: int = 5, page_size: int = 10):
+    """Print query throughput and the coordinator's own CPU time per query.
+
+    The coordinator CPU time bounds the throughput sharding can reach however
+    many cores run the shards, so it is the number to compare with the
+    single-process baseline on a machine with few cores.
+    """
+    import time
+    from locationdb import CityDataBase
+
+    if shard_counts is None:
+        shard_counts = [1]
+        while shard_counts[-1] * 2 <= multiprocessing.cpu_count():
+            shard_counts.append(shard_counts[-1] * 2)
+
+    single_db = CityDataBase()
+    single_db.open_from_json()
+    queries = sorted({city.searchable_name_normalized()[:3] for city in single_db})
+    total = len(queries) * rounds
+
+    def measure(label: str, run_round):
+        wall, cpu = time.perf_counter(), time.process_time()
+        for _ in range(rounds):
+            run_round()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        print(f"  {label:<12}{total / wall:>10.0f} queries/s"
+              f"{cpu * 10 ** 6 / total:>10.2f} us coordinator CPU/query")
+
+    print(f"{len(queries)} queries x {rounds} rounds, {multiprocessing.cpu_count()} CPU(s)")
+    print("single process CityDataBase (baseline):")
+    measure("search", lambda: [single_db.search(text) for text in queries])
+    measure(f"page {page_size}", lambda: [single_db.search(text)[:page_size] for text in queries])
+    measure("count", lambda: [len(single_db.search(text)) for text in queries])
+    del single_db
+
+    for shards_count in shard_counts:
+        with ShardedCityDataBase(shards_count, partition) as db:
+            db.open_from_json()
+            print(f"{shards_count} shard(s) {db.shard_sizes()}:")
+            measure("search", lambda: db.search_many(queries))
+            measure(f"page {page_size}", lambda: db.search_many(queries, page_size))
+            measure("count", lambda: db.count_many(queries))
+
+
+def main():
+    import sys
+
+    partition = sys.argv[1] if len(sys.argv) > 1 else PARTITION_BY_COUNTRY
+    shard_counts = [int(arg) for arg in sys.argv[2:]] or None
+    benchmark(shard_counts, partition)
+
+
+if __name__ == "__main__":
+    main()